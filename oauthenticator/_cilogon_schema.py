@@ -0,0 +1,71 @@
+"""
+This JSONSchema is used to validate the values in the
+CILogonOAuthenticator.allowed_idps dictionary.
+
+It is declared as a Python dictionary instead of being parsed from a file so
+that validating allowed_idps doesn't require reading and parsing any files.
+"""
+
+ALLOWED_IDPS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["username_derivation"],
+    "properties": {
+        "allow_all": {
+            "type": "boolean",
+        },
+        "allowed_domains": {
+            "type": "array",
+            "items": {
+                "type": "string",
+            },
+        },
+        "username_derivation": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["username_claim"],
+            "properties": {
+                "username_claim": {
+                    "type": "string",
+                },
+                "action": {
+                    "type": "string",
+                    "enum": ["strip_idp_domain", "prefix"],
+                },
+                "domain": {
+                    "type": "string",
+                },
+                "prefix": {
+                    "type": "string",
+                },
+            },
+            "allOf": [
+                # if action is strip_idp_domain, then domain is required
+                {
+                    "if": {
+                        "properties": {
+                            "action": {"const": "strip_idp_domain"},
+                        },
+                        "required": ["action"],
+                    },
+                    "then": {
+                        "required": ["domain"],
+                    },
+                },
+                # if action is prefix, then prefix is required
+                {
+                    "if": {
+                        "properties": {
+                            "action": {"const": "prefix"},
+                        },
+                        "required": ["action"],
+                    },
+                    "then": {
+                        "required": ["prefix"],
+                    },
+                },
+            ],
+        },
+    },
+}
@@ -1,18 +1,92 @@
 """
 A JupyterHub authenticator class for use with CILogon as an identity provider.
 """
+import copy
 import os
+from collections import namedtuple
 from urllib.parse import urlparse
 
 import jsonschema
 from jupyterhub.auth import LocalAuthenticator
-from ruamel.yaml import YAML
 from tornado import web
 from traitlets import Bool, Dict, List, Unicode, default, validate
 
+from ._cilogon_schema import ALLOWED_IDPS_SCHEMA
 from .oauth2 import OAuthenticator, OAuthLoginHandler
 
-yaml = YAML(typ="safe", pure=True)
+# the URL schemes of the EntityIDs accepted as keys in allowed_idps
+_ACCEPTED_ENTITY_ID_SCHEMES = frozenset(["urn", "https", "http"])
+
+_allowed_idps_validator = None
+
+
+def _get_allowed_idps_validator():
+    """
+    Returns a jsonschema validator for the values in allowed_idps.
+
+    The validator is constructed on first use, and the schema is checked
+    against its meta-schema only then instead of for each validated value.
+    """
+    global _allowed_idps_validator
+    if _allowed_idps_validator is None:
+        schema = ALLOWED_IDPS_SCHEMA
+        validator_cls = jsonschema.validators.validator_for(schema)
+        validator_cls.check_schema(schema)
+        _allowed_idps_validator = validator_cls(schema)
+    return _allowed_idps_validator
+
+
+def _build_username_action(username_derivation):
+    """
+    Returns a function adjusting a username based on the "action" specified in
+    a `username_derivation` config of allowed_idps.
+    """
+    action = username_derivation.get("action")
+    if action == "strip_idp_domain":
+        domain_suffix = "@" + username_derivation["domain"]
+        domain_suffix_lower = domain_suffix.lower()
+
+        def strip_idp_domain(username):
+            if username.lower().endswith(domain_suffix_lower):
+                username = username[: -len(domain_suffix)]
+            return username
+
+        return strip_idp_domain
+    elif action == "prefix":
+        prefix = username_derivation["prefix"]
+
+        def add_prefix(username):
+            return f"{prefix}:{username}"
+
+        return add_prefix
+    else:
+
+        def no_action(username):
+            return username
+
+        return no_action
+
+
+# the config of an idp in allowed_idps, precomputed for use when users login,
+# and the idp's config it was derived from
+_DerivedIdpConfig = namedtuple(
+    "_DerivedIdpConfig",
+    ["source", "username_claim", "username_action", "allow_all", "allowed_domains"],
+)
+
+
+def _derive_idp_config(idp_config):
+    """
+    Returns a _DerivedIdpConfig based on an idp's config in allowed_idps.
+    """
+    username_derivation = idp_config["username_derivation"]
+    return _DerivedIdpConfig(
+        source=copy.deepcopy(idp_config),
+        username_claim=username_derivation["username_claim"],
+        username_action=_build_username_action(username_derivation),
+        allow_all=bool(idp_config.get("allow_all")),
+        allowed_domains=frozenset(idp_config.get("allowed_domains") or ()),
+    )
 
 
 class CILogonLoginHandler(OAuthLoginHandler):
@@ -30,7 +104,7 @@ class CILogonLoginHandler(OAuthLoginHandler):
         extra_params = kwargs.setdefault('extra_params', {})
 
         # selected_idp should be a comma separated string
-        allowed_idps = ",".join(self.authenticator.allowed_idps.keys())
+        allowed_idps = ",".join(self.authenticator.allowed_idps)
         extra_params["selected_idp"] = allowed_idps
 
         if self.authenticator.skin:
@@ -187,19 +261,17 @@ class CILogonOAuthenticator(OAuthenticator):
         if not idps:
             raise ValueError("One or more allowed_idps must be configured")
 
+        validator = _get_allowed_idps_validator()
         for entity_id, idp_config in idps.items():
-            # Validate `idp_config` config using the schema
-            root_dir = os.path.dirname(os.path.abspath(__file__))
-            schema_file = os.path.join(root_dir, "schemas", "cilogon-schema.yaml")
-            with open(schema_file) as schema_fd:
-                schema = yaml.load(schema_fd)
-                # Raises useful exception if validation fails
-                jsonschema.validate(idp_config, schema)
+            # Validate `idp_config` config using the schema, raising the same
+            # useful exception as jsonschema.validate would if it fails
+            error = jsonschema.exceptions.best_match(validator.iter_errors(idp_config))
+            if error is not None:
+                raise error
 
             # Make sure allowed_idps contains EntityIDs and not domain names.
-            accepted_entity_id_scheme = ["urn", "https", "http"]
             entity_id_scheme = urlparse(entity_id).scheme
-            if entity_id_scheme not in accepted_entity_id_scheme:
+            if entity_id_scheme not in _ACCEPTED_ENTITY_ID_SCHEMES:
                 # Validate entity ids are the form of: `https://github.com/login/oauth/authorize`
                 self.log.error(
                     f"Trying to allow an auth provider: {entity_id}, that doesn't look like a valid CILogon EntityID.",
@@ -209,8 +281,29 @@ class CILogonOAuthenticator(OAuthenticator):
                     "See https://cilogon.org/idplist for the list of EntityIDs of each IDP."
                 )
 
+        self._derived_idp_configs = {
+            entity_id: _derive_idp_config(idp_config)
+            for entity_id, idp_config in idps.items()
+        }
+
         return idps
 
+    # _derived_idp_configs maps the EntityIDs in allowed_idps to a
+    # _DerivedIdpConfig, and is accessed via _get_derived_idp_config
+    _derived_idp_configs = Dict()
+
+    def _get_derived_idp_config(self, user_idp):
+        """
+        Returns the _DerivedIdpConfig of an idp in allowed_idps, derived again
+        if allowed_idps has been changed in place since it was validated.
+        """
+        idp_config = self.allowed_idps[user_idp]
+        derived_config = self._derived_idp_configs.get(user_idp)
+        if derived_config is None or derived_config.source != idp_config:
+            derived_config = _derive_idp_config(idp_config)
+            self._derived_idp_configs[user_idp] = derived_config
+        return derived_config
+
     skin = Unicode(
         config=True,
         help="""
@@ -315,8 +408,7 @@ class CILogonOAuthenticator(OAuthenticator):
         specified under "username_derivation" for the associated idp.
         """
         user_idp = user_info["idp"]
-        username_derivation = self.allowed_idps[user_idp]["username_derivation"]
-        username_claim = username_derivation["username_claim"]
+        username_claim = self._get_derived_idp_config(user_idp).username_claim
 
         username = user_info.get(username_claim)
         if not username:
@@ -332,19 +424,8 @@ class CILogonOAuthenticator(OAuthenticator):
         specified under "username_derivation" for the associated idp.
         """
         user_idp = user_info["idp"]
-        username_derivation = self.allowed_idps[user_idp]["username_derivation"]
-
-        # Optionally execute action "strip_idp_domain" or "prefix"
-        action = username_derivation.get("action")
-        if action == "strip_idp_domain":
-            domain_suffix = "@" + username_derivation["domain"]
-            if username.lower().endswith(domain_suffix.lower()):
-                username = username[: -len(domain_suffix)]
-        elif action == "prefix":
-            prefix = username_derivation["prefix"]
-            username = f"{prefix}:{username}"
-
-        return username
+        username_action = self._get_derived_idp_config(user_idp).username_action
+        return username_action(username)
 
     async def check_allowed(self, username, auth_model):
         """
@@ -358,11 +439,11 @@ class CILogonOAuthenticator(OAuthenticator):
         user_info = auth_model["auth_state"][self.user_auth_state_key]
         user_idp = user_info["idp"]
 
-        idp_allow_all = self.allowed_idps[user_idp].get("allow_all")
-        if idp_allow_all:
+        idp_config = self._get_derived_idp_config(user_idp)
+        if idp_config.allow_all:
             return True
 
-        idp_allowed_domains = self.allowed_idps[user_idp].get("allowed_domains")
+        idp_allowed_domains = idp_config.allowed_domains
         if idp_allowed_domains:
             unprocessed_username = self._user_info_to_unprocessed_username(user_info)
             user_domain = unprocessed_username.split("@", 1)[1].lower()
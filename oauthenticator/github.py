@@ -1,16 +1,136 @@
 """
 A JupyterHub authenticator class for use with GitHub as an identity provider.
 """
+import asyncio
 import json
 import os
+import re
+import time
 import warnings
+from functools import lru_cache
+from urllib.parse import parse_qs, urlparse, urlunparse
 
 from jupyterhub.auth import LocalAuthenticator
-from requests.utils import parse_header_links
-from traitlets import Bool, Set, Unicode, default
+from traitlets import Bool, Dict, Float, Set, Unicode, default
 
 from .oauth2 import OAuthenticator
 
+try:
+    # orjson is optionally used to parse GitHub API responses faster
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# matches the URL of the rel="next" link in a Link header of a paginated
+# GitHub API response, like: <https://api.github.com/...&page=2>; rel="next"
+_NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+_LAST_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="last"')
+
+# the maximum number of pages of a paginated GitHub API response to fetch
+# concurrently
+_MAX_CONCURRENT_PAGE_FETCHES = 5
+
+# the maximum number of found organization memberships to remember
+_ORG_MEMBERSHIP_CACHE_MAX_SIZE = 10000
+
+# lists the organizations of the authenticated user, and the teams in them the
+# user with the login $login is a member of
+_ORG_MEMBERSHIP_GRAPHQL_QUERY = """
+query($login: String!) {
+  viewer {
+    organizations(first: 100) {
+      nodes {
+        login
+        teams(first: 100, userLogins: [$login]) {
+          nodes {
+            slug
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def _get_page_urls(next_url, last_url):
+    """
+    Returns the URLs of the pages from `next_url` to `last_url`, based on their
+    `page` query parameter, or None if they don't have one.
+
+    Only the `page` query parameter of `last_url` is changed to build the URLs.
+    """
+    next_query = parse_qs(urlparse(next_url).query, keep_blank_values=True)
+    last_urlinfo = urlparse(last_url)
+    last_query_params = last_urlinfo.query.split("&")
+    page_param_indexes = [
+        i for i, param in enumerate(last_query_params) if param.startswith("page=")
+    ]
+    if len(page_param_indexes) != 1:
+        return None
+    page_param_index = page_param_indexes[0]
+    try:
+        next_page = int(next_query["page"][0])
+        last_page = int(last_query_params[page_param_index][len("page=") :])
+    except (KeyError, ValueError):
+        return None
+
+    page_urls = []
+    for page in range(next_page, last_page + 1):
+        last_query_params[page_param_index] = f"page={page}"
+        query = "&".join(last_query_params)
+        page_urls.append(urlunparse(last_urlinfo._replace(query=query)))
+    return page_urls
+
+
+@lru_cache
+def _split_org_team(org_team):
+    """
+    Splits an entry of allowed_organizations like `org-b:team-1` into its
+    organization and team, where the team is None for entries like `org-a`.
+
+    Raises a ValueError for entries with more than one ":".
+    """
+    if ":" in org_team:
+        org, team = org_team.split(":")
+        return org, team
+    return org_team, None
+
+
+@lru_cache(maxsize=1)
+def _resolve_github_url(github_url, host, http):
+    """
+    Returns the default value of `github_url` based on the values of the
+    GITHUB_URL, GITHUB_HOST, and GITHUB_HTTP environment variables.
+    """
+    if not github_url:
+        # fallback on older GITHUB_HOST config,
+        # treated the same as GITHUB_URL
+        if host:
+            if http:
+                protocol = "http"
+                warnings.warn(
+                    "Use of GITHUB_HOST with GITHUB_HTTP might be deprecated in the future. "
+                    f"Use GITHUB_URL=http://{host} to set host and protocol together.",
+                    PendingDeprecationWarning,
+                )
+            else:
+                protocol = "https"
+            github_url = f"{protocol}://{host}"
+
+    if github_url:
+        if '://' not in github_url:
+            # ensure protocol is included, assume https if missing
+            github_url = 'https://' + github_url
+
+        return github_url
+    else:
+        # nothing specified, this is the true default
+        github_url = "https://github.com"
+
+    # ensure no trailing slash
+    return github_url.rstrip("/")
+
 
 class GitHubOAuthenticator(OAuthenticator):
     user_auth_state_key = "github_user"
@@ -33,35 +153,11 @@ class GitHubOAuthenticator(OAuthenticator):
 
     @default("github_url")
     def _github_url_default(self):
-        github_url = os.environ.get("GITHUB_URL")
-        if not github_url:
-            # fallback on older GITHUB_HOST config,
-            # treated the same as GITHUB_URL
-            host = os.environ.get("GITHUB_HOST")
-            if host:
-                if os.environ.get("GITHUB_HTTP"):
-                    protocol = "http"
-                    warnings.warn(
-                        "Use of GITHUB_HOST with GITHUB_HTTP might be deprecated in the future. "
-                        f"Use GITHUB_URL=http://{host} to set host and protocol together.",
-                        PendingDeprecationWarning,
-                    )
-                else:
-                    protocol = "https"
-                github_url = f"{protocol}://{host}"
-
-        if github_url:
-            if '://' not in github_url:
-                # ensure protocol is included, assume https if missing
-                github_url = 'https://' + github_url
-
-            return github_url
-        else:
-            # nothing specified, this is the true default
-            github_url = "https://github.com"
-
-        # ensure no trailing slash
-        return github_url.rstrip("/")
+        return _resolve_github_url(
+            os.environ.get("GITHUB_URL"),
+            os.environ.get("GITHUB_HOST"),
+            os.environ.get("GITHUB_HTTP"),
+        )
 
     github_api = Unicode(
         config=True,
@@ -114,6 +210,29 @@ class GitHubOAuthenticator(OAuthenticator):
         """,
     )
 
+    org_membership_cache_ttl = Float(
+        300,
+        config=True,
+        help="""
+        Number of seconds to remember that a user was found to be a member of
+        an entry in `allowed_organizations`, to avoid asking GitHub's API again
+        when the user logs in again within that time.
+
+        Users not found to be members are not remembered, so users added to an
+        organization are allowed right away, but users removed from an
+        organization are still allowed for up to this many seconds.
+
+        Set to 0 to always ask GitHub's API.
+
+        .. versionadded:: 16.2
+        """,
+    )
+
+    # _org_membership_cache maps (org_team, username) to the time.monotonic()
+    # timestamp of when the user was found to be a member of org_team, ordered
+    # from the oldest to the most recent timestamp
+    _org_membership_cache = Dict()
+
     populate_teams_in_auth_state = Bool(
         False,
         config=True,
@@ -176,11 +295,40 @@ class GitHubOAuthenticator(OAuthenticator):
         if self.allowed_organizations:
             access_token = auth_model["auth_state"]["token_response"]["access_token"]
             token_type = auth_model["auth_state"]["token_response"]["token_type"]
+
+            # a membership remembered from a previous login requires no requests
             for org_team in self.allowed_organizations:
-                if await self._check_membership_allowed_organizations(
-                    org_team, username, access_token, token_type
-                ):
+                if self._is_cached_org_member(org_team, username):
                     return True
+
+            # check membership of all organizations concurrently, and stop at
+            # the first one the user is found to be a member of
+            tasks = [
+                asyncio.create_task(
+                    self._check_membership_allowed_organizations(
+                        org_team, username, access_token, token_type
+                    )
+                )
+                for org_team in self.allowed_organizations
+            ]
+            # with multiple organizations to check, also try to find a
+            # membership for all of them with a single GraphQL API request,
+            # which may respond before the REST API requests
+            if len(self.allowed_organizations) > 1 and "read:org" in self.scope:
+                tasks.append(
+                    asyncio.create_task(
+                        self._check_membership_allowed_organizations_graphql(
+                            username, access_token, token_type
+                        )
+                    )
+                )
+            try:
+                for next_completed in asyncio.as_completed(tasks):
+                    if await next_completed:
+                        return True
+            finally:
+                for task in tasks:
+                    task.cancel()
             message = f"User {username} is not part of allowed_organizations"
             self.log.warning(message)
 
@@ -207,9 +355,9 @@ class GitHubOAuthenticator(OAuthenticator):
         # Note that the read:user scope does not imply the user:emails scope!
         access_token = auth_model["auth_state"]["token_response"]["access_token"]
         token_type = auth_model["auth_state"]["token_response"]["token_type"]
-        granted_scopes = auth_model["auth_state"].get("scope", [])
-        if not user_info["email"] and (
-            "user" in granted_scopes or "user:email" in granted_scopes
+        granted_scopes = frozenset(auth_model["auth_state"].get("scope", []))
+        if not user_info.get("email") and not granted_scopes.isdisjoint(
+            {"user", "user:email"}
         ):
             resp_json = await self.httpfetch(
                 f"{self.github_api}/user/emails",
@@ -243,22 +391,32 @@ class GitHubOAuthenticator(OAuthenticator):
         Fetch all items via a paginated GitHub API call
 
         Makes a request to api_url, and if pagination information is returned,
-        keep paginating until all the items are retrieved.
+        keep paginating until all the items are retrieved. If the pagination
+        information includes a 'last' link, the remaining pages are fetched
+        concurrently.
         """
-        url = api_url
-        content = []
-        while True:
-            resp = await self.httpfetch(
+        headers = self.build_userdata_request_headers(access_token, token_type)
+        # GitHub's recommended media type for its REST API
+        # https://docs.github.com/en/rest/overview/media-types
+        headers["Accept"] = "application/vnd.github+json"
+
+        def fetch_page(url):
+            return self.httpfetch(
                 url,
                 "fetching user teams",
                 parse_json=False,
                 method="GET",
-                headers=self.build_userdata_request_headers(access_token, token_type),
+                headers=headers,
                 validate_cert=self.validate_server_cert,
             )
 
-            resp_json = json.loads(resp.body.decode())
-            content += resp_json
+        url = api_url
+        content = []
+        while True:
+            resp = await fetch_page(url)
+
+            resp_json = _json_loads(resp.body)
+            content.extend(resp_json)
 
             # Check if a Link header is present, with a collection of pagination links
             links_header = resp.headers.get('Link')
@@ -266,22 +424,40 @@ class GitHubOAuthenticator(OAuthenticator):
                 # If Link header is not present, we just exit
                 break
 
-            # If Link header is present, let's parse it.
-            links = parse_header_links(links_header)
+            # If Link header is present, look for a 'next' link in it
+            next_link = _NEXT_LINK_RE.search(links_header)
+            if next_link is None:
+                # If not, we're out of pages to paginate, so we stop
+                break
 
-            next_url = None
-            # Look through all links to see if there is a 'next' link present
-            for l in links:
-                if l.get('rel') == 'next':
-                    next_url = l['url']
+            # If we also found a 'last' link, we know the URLs of all remaining
+            # pages and fetch them concurrently
+            last_link = _LAST_LINK_RE.search(links_header)
+            if last_link is not None:
+                page_urls = _get_page_urls(next_link.group(1), last_link.group(1))
+                if page_urls:
+                    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_PAGE_FETCHES)
+
+                    async def fetch_page_limited(url):
+                        async with semaphore:
+                            return await fetch_page(url)
+
+                    tasks = [
+                        asyncio.create_task(fetch_page_limited(page_url))
+                        for page_url in page_urls
+                    ]
+                    try:
+                        page_resps = await asyncio.gather(*tasks)
+                    finally:
+                        # if a page failed to be fetched, stop fetching the rest
+                        for task in tasks:
+                            task.cancel()
+                    for page_resp in page_resps:
+                        content.extend(_json_loads(page_resp.body))
                     break
 
-            # If we found a 'next' link, continue the while loop with the new URL
-            # If not, we're out of pages to paginate, so we stop
-            if next_url is not None:
-                url = next_url
-            else:
-                break
+            # Otherwise continue the while loop with the 'next' link's URL
+            url = next_link.group(1)
         return content
 
     async def _check_membership_allowed_organizations(
@@ -296,17 +472,20 @@ class GitHubOAuthenticator(OAuthenticator):
         and will adjust to use a the relevant REST API to check either org or
         team membership.
         """
+        if self._is_cached_org_member(org_team, username):
+            return True
+        cache_key = (org_team, username)
+
         headers = self.build_userdata_request_headers(access_token, token_type)
 
-        if ":" in org_team:
+        org, team = _split_org_team(org_team)
+        if team is not None:
             # check if user is part of an organization's team
             # https://docs.github.com/en/rest/teams/members?apiVersion=2022-11-28#get-team-member-legacy
-            org, team = org_team.split(":")
             api_url = f"{self.github_api}/orgs/{org}/teams/{team}/members/{username}"
         else:
             # check if user is part of an organization
             # https://docs.github.com/en/rest/orgs/members?apiVersion=2022-11-28#check-organization-membership-for-a-user
-            org = org_team
             api_url = f"{self.github_api}/orgs/{org}/members/{username}"
 
         self.log.debug(f"Checking GitHub organization membership: {username} in {org}?")
@@ -320,10 +499,11 @@ class GitHubOAuthenticator(OAuthenticator):
         )
         if resp.code == 204:
             self.log.debug(f"Allowing {username} as member of {org_team}")
+            self._cache_org_membership(cache_key)
             return True
         else:
             try:
-                resp_json = json.loads((resp.body or b'').decode('utf8', 'replace'))
+                resp_json = _json_loads(resp.body or b'{}')
                 message = resp_json.get('message', '')
             except ValueError:
                 message = ''
@@ -332,6 +512,109 @@ class GitHubOAuthenticator(OAuthenticator):
             )
         return False
 
+    async def _check_membership_allowed_organizations_graphql(
+        self, username, access_token, token_type
+    ):
+        """
+        Checks if a user is part of any organization or organization's team in
+        `allowed_organizations` via a single request to GitHub's GraphQL API.
+        The `read:org` scope is required.
+
+        Only a found membership is considered conclusive, as the GraphQL API
+        lists at most 100 organizations and teams per organization, and may
+        not list organizations restricting access for OAuth apps. This is why
+        it is made alongside, not instead of, the REST API requests.
+        """
+        if self.github_api.endswith("/api/v3"):
+            # GitHub Enterprise Server has its GraphQL API under /api/graphql
+            graphql_url = self.github_api[: -len("/v3")] + "/graphql"
+        else:
+            graphql_url = self.github_api + "/graphql"
+
+        headers = self.build_userdata_request_headers(access_token, token_type)
+        body = {
+            "query": _ORG_MEMBERSHIP_GRAPHQL_QUERY,
+            "variables": {"login": username},
+        }
+
+        self.log.debug(f"Checking GitHub organization memberships of {username}")
+        resp = await self.httpfetch(
+            graphql_url,
+            parse_json=False,
+            raise_error=False,
+            method="POST",
+            headers=headers,
+            body=json.dumps(body),
+            validate_cert=self.validate_server_cert,
+        )
+        if resp.code != 200:
+            self.log.debug(
+                f"Failed to check organization memberships via GraphQL (status={resp.code})"
+            )
+            return False
+        try:
+            resp_json = _json_loads(resp.body)
+            orgs = resp_json["data"]["viewer"]["organizations"]["nodes"]
+        except (ValueError, KeyError, TypeError):
+            self.log.debug("Unexpected response checking memberships via GraphQL")
+            return False
+
+        memberships = set()
+        for org in orgs or []:
+            # organizations restricting access for OAuth apps are listed with
+            # teams set to null, alongside an errors list in the response, and
+            # are skipped to be checked via the REST API instead
+            teams = (org or {}).get("teams") or {}
+            if teams.get("nodes") is None:
+                continue
+            memberships.add(org["login"].lower())
+            for team in teams["nodes"]:
+                if team:
+                    memberships.add(f"{org['login']}:{team['slug']}".lower())
+
+        for org_team in self.allowed_organizations:
+            if org_team.lower() in memberships:
+                self.log.debug(f"Allowing {username} as member of {org_team}")
+                self._cache_org_membership((org_team, username))
+                return True
+        return False
+
+    def _is_cached_org_member(self, org_team, username):
+        """
+        Returns True if the user was found to be a member of `org_team` within
+        the last `org_membership_cache_ttl` seconds.
+        """
+        timestamp = self._org_membership_cache.get((org_team, username))
+        return bool(
+            timestamp
+            and time.monotonic() - timestamp < self.org_membership_cache_ttl
+        )
+
+    def _cache_org_membership(self, cache_key):
+        """
+        Remembers a found membership for `org_membership_cache_ttl` seconds.
+
+        Expired entries are removed, and the oldest entries are removed if the
+        cache would grow beyond _ORG_MEMBERSHIP_CACHE_MAX_SIZE entries.
+        """
+        if self.org_membership_cache_ttl <= 0:
+            return
+
+        cache = self._org_membership_cache
+        now = time.monotonic()
+        while cache:
+            oldest_key = next(iter(cache))
+            if (
+                now - cache[oldest_key] < self.org_membership_cache_ttl
+                and len(cache) < _ORG_MEMBERSHIP_CACHE_MAX_SIZE
+            ):
+                break
+            del cache[oldest_key]
+
+        # re-insert the entry to keep the cache ordered by timestamp
+        cache.pop(cache_key, None)
+        cache[cache_key] = now
+
 
 class LocalGitHubOAuthenticator(LocalAuthenticator, GitHubOAuthenticator):
     """A version that mixes in local system user creation"""
@@ -585,6 +585,10 @@ class OAuthenticator(Authenticator):
 
     @default("http_client")
     def _default_http_client(self):
+        # AsyncHTTPClient() returns an instance shared per event loop, so all
+        # requests made by an authenticator are made with the same client.
+        # JupyterHub configures it to be CurlAsyncHTTPClient if pycurl is
+        # installed, which also re-uses connections between requests.
         return AsyncHTTPClient()
 
     async def fetch(self, req, label="fetching", parse_json=True, **kwargs):
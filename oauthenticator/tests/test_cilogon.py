@@ -675,3 +675,72 @@ async def test_allowed_idps_username_derivation_actions(cilogon_client):
     auth_model = await authenticator.get_authenticated_user(handler, None)
     print(json.dumps(auth_model, sort_keys=True, indent=4))
     assert auth_model['name'] == 'jtkirk'
+
+
+async def test_allowed_idps_updated_in_place(cilogon_client):
+    """
+    Tests that changes to `allowed_idps` made in place are respected, both for
+    added idps and for changes to the config of already configured idps.
+    """
+    c = Config()
+    c.CILogonOAuthenticator.allow_all = True
+    c.CILogonOAuthenticator.allowed_idps = {
+        'https://some-idp.com/login/oauth/authorize': {
+            'username_derivation': {
+                'username_claim': 'email',
+            },
+        },
+    }
+    authenticator = CILogonOAuthenticator(config=c)
+    authenticator.allowed_idps['https://prefix.example.com/login/oauth/authorize'] = {
+        'username_derivation': {
+            'username_claim': 'nickname',
+            'action': 'prefix',
+            'prefix': 'some-prefix',
+        },
+    }
+
+    handler = cilogon_client.handler_for_user(
+        user_model(
+            'jtkirk', 'nickname', idp='https://prefix.example.com/login/oauth/authorize'
+        )
+    )
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model['name'] == 'some-prefix:jtkirk'
+
+    # change the config of an already configured idp in place
+    idp_config = authenticator.allowed_idps[
+        'https://prefix.example.com/login/oauth/authorize'
+    ]
+    idp_config['username_derivation']['prefix'] = 'other-prefix'
+    handler = cilogon_client.handler_for_user(
+        user_model(
+            'jtkirk', 'nickname', idp='https://prefix.example.com/login/oauth/authorize'
+        )
+    )
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model['name'] == 'other-prefix:jtkirk'
+
+    # allow_all and allowed_domains changed in place are respected together
+    authenticator.allow_all = False
+    idp_config['allowed_domains'] = ['example.org']
+    handler = cilogon_client.handler_for_user(
+        user_model(
+            'jtkirk@example.org',
+            'nickname',
+            idp='https://prefix.example.com/login/oauth/authorize',
+        )
+    )
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model['name'] == 'other-prefix:jtkirk@example.org'
+
+    idp_config['allowed_domains'] = ['example.com']
+    handler = cilogon_client.handler_for_user(
+        user_model(
+            'jtkirk@example.org',
+            'nickname',
+            idp='https://prefix.example.com/login/oauth/authorize',
+        )
+    )
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model is None
@@ -6,10 +6,11 @@ from io import BytesIO
 from urllib.parse import parse_qs, urlparse
 
 from pytest import fixture, mark, raises
-from tornado.httpclient import HTTPResponse
+from tornado.httpclient import HTTPClientError, HTTPResponse
 from tornado.httputil import HTTPHeaders
 from traitlets.config import Config
 
+from .. import github
 from ..github import GitHubOAuthenticator
 from .mocks import setup_oauth_mock
 
@@ -216,6 +217,21 @@ async def test_allowed_org_membership(github_client):
         auth_model = await authenticator.get_authenticated_user(handler, None)
         assert auth_model is None
 
+        # test membership of one out of multiple orgs, with the org the user is
+        # a member of added to allowed_organizations in place
+        authenticator.allowed_organizations = ["org2", "org3:team1"]
+        authenticator.allowed_organizations.add("org1")
+
+        handled_user_model = user_model("user1")
+        handler = github_client.handler_for_user(handled_user_model)
+        auth_model = await authenticator.get_authenticated_user(handler, None)
+        assert auth_model
+
+        handled_user_model = user_model("user-not-in-org")
+        handler = github_client.handler_for_user(handled_user_model)
+        auth_model = await authenticator.get_authenticated_user(handler, None)
+        assert auth_model is None
+
         # test org team membership
         authenticator.allowed_organizations = ["org1:team1"]
 
@@ -232,6 +248,222 @@ async def test_allowed_org_membership(github_client):
         client_hosts.pop()
 
 
+async def test_allowed_org_membership_graphql(github_client):
+    c = Config()
+    c.GitHubOAuthenticator.allowed_organizations = {"org1", "org2:team1"}
+    c.GitHubOAuthenticator.scope = ["read:org"]
+    authenticator = GitHubOAuthenticator(config=c)
+
+    viewer_orgs = {
+        "user1": [{"login": "Org2", "teams": {"nodes": [{"slug": "team1"}]}}],
+        "user2": [{"login": "org2", "teams": {"nodes": [{"slug": "team2"}]}}],
+        # organizations restricting access for OAuth apps are listed like this
+        "user3": [
+            {"login": "org1", "teams": None},
+            {"login": "org2", "teams": {"nodes": None}},
+            None,
+        ],
+    }
+    graphql_requests = []
+
+    def graphql(request):
+        assert request.method == "POST"
+        login = json.loads(request.body)["variables"]["login"]
+        graphql_requests.append(login)
+        return {"data": {"viewer": {"organizations": {"nodes": viewer_orgs[login]}}}}
+
+    github_client.hosts['api.github.com'].append(('/graphql', graphql))
+
+    handler = github_client.handler_for_user(user_model("user1"))
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model
+
+    # not found to be a member via GraphQL, and the REST API isn't mocked to
+    # respond with any memberships
+    handler = github_client.handler_for_user(user_model("user2"))
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model is None
+
+    # GraphQL response without any conclusive memberships, with the REST API
+    # requests made alongside it not mocked to respond with any memberships
+    handler = github_client.handler_for_user(user_model("user3"))
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+    assert auth_model is None
+
+    assert graphql_requests == ["user1", "user2", "user3"]
+
+
+async def test_allowed_org_membership_graphql_cached(github_client):
+    c = Config()
+    c.GitHubOAuthenticator.allowed_organizations = {"org1", "org2"}
+    c.GitHubOAuthenticator.scope = ["read:org"]
+    authenticator = GitHubOAuthenticator(config=c)
+    authenticator._cache_org_membership(("org1", "user1"))
+
+    graphql_requests = []
+
+    def graphql(request):
+        graphql_requests.append(json.loads(request.body)["variables"]["login"])
+        return {"data": {"viewer": {"organizations": {"nodes": []}}}}
+
+    github_client.hosts['api.github.com'].append(('/graphql', graphql))
+
+    for _ in range(3):
+        handler = github_client.handler_for_user(user_model("user1"))
+        auth_model = await authenticator.get_authenticated_user(handler, None)
+        assert auth_model
+
+    assert graphql_requests == []
+
+
+@mark.parametrize("include_last_link", [True, False])
+async def test_populate_teams_in_auth_state(github_client, include_last_link):
+    c = Config()
+    c.GitHubOAuthenticator.allow_all = True
+    c.GitHubOAuthenticator.populate_teams_in_auth_state = True
+    c.GitHubOAuthenticator.scope = ["read:org"]
+    authenticator = GitHubOAuthenticator(config=c)
+
+    last_page = 3
+
+    def user_teams(request):
+        urlinfo = urlparse(request.url)
+        page = int(parse_qs(urlinfo.query).get('page', ['1'])[0])
+        base_url = f"{urlinfo.scheme}://{urlinfo.netloc}{urlinfo.path}?per_page=100"
+        links = []
+        if page > 1:
+            links.append(f'<{base_url}&page={page - 1}>; rel="prev"')
+        if page < last_page:
+            links.append(f'<{base_url}&page={page + 1}>; rel="next"')
+        if include_last_link:
+            links.append(f'<{base_url}&page={last_page}>; rel="last"')
+        return HTTPResponse(
+            request,
+            200,
+            headers=HTTPHeaders(
+                {'Content-Type': 'application/json', 'Link': ", ".join(links)}
+            ),
+            buffer=BytesIO(
+                json.dumps([{"slug": f"team{page}-{i}"} for i in (1, 2)]).encode()
+            ),
+        )
+
+    github_client.hosts['api.github.com'].append(('/user/teams', user_teams))
+
+    handler = github_client.handler_for_user(user_model("user1"))
+    auth_model = await authenticator.get_authenticated_user(handler, None)
+
+    teams = auth_model["auth_state"]["teams"]
+    assert [team["slug"] for team in teams] == [
+        f"team{page}-{i}" for page in range(1, last_page + 1) for i in (1, 2)
+    ]
+
+
+def test_get_page_urls():
+    # only the page query parameter is changed, keeping blank parameters
+    assert github._get_page_urls(
+        "https://api.github.com/user/teams?per_page=100&q=&page=2",
+        "https://api.github.com/user/teams?per_page=100&q=&page=4",
+    ) == [
+        "https://api.github.com/user/teams?per_page=100&q=&page=2",
+        "https://api.github.com/user/teams?per_page=100&q=&page=3",
+        "https://api.github.com/user/teams?per_page=100&q=&page=4",
+    ]
+    assert (
+        github._get_page_urls(
+            "https://api.github.com/user/teams?after=abc",
+            "https://api.github.com/user/teams?page=4",
+        )
+        is None
+    )
+
+
+async def test_populate_teams_in_auth_state_failed_page(github_client):
+    c = Config()
+    c.GitHubOAuthenticator.allow_all = True
+    c.GitHubOAuthenticator.populate_teams_in_auth_state = True
+    c.GitHubOAuthenticator.scope = ["read:org"]
+    authenticator = GitHubOAuthenticator(config=c)
+
+    def user_teams(request):
+        urlinfo = urlparse(request.url)
+        page = int(parse_qs(urlinfo.query).get('page', ['1'])[0])
+        if page == 2:
+            return HTTPResponse(request, 500)
+        base_url = f"{urlinfo.scheme}://{urlinfo.netloc}{urlinfo.path}?per_page=100"
+        links = f'<{base_url}&page=2>; rel="next", <{base_url}&page=20>; rel="last"'
+        return HTTPResponse(
+            request,
+            200,
+            headers=HTTPHeaders({'Content-Type': 'application/json', 'Link': links}),
+            buffer=BytesIO(json.dumps([{"slug": f"team{page}"}]).encode()),
+        )
+
+    github_client.hosts['api.github.com'].append(('/user/teams', user_teams))
+
+    handler = github_client.handler_for_user(user_model("user1"))
+    with raises(HTTPClientError):
+        await authenticator.get_authenticated_user(handler, None)
+
+
+@mark.parametrize(
+    "org_membership_cache_ttl,is_member,expect_requests",
+    [
+        (300, True, 1),
+        (0, True, 2),
+        # not found memberships aren't remembered
+        (300, False, 2),
+    ],
+)
+async def test_org_membership_cache(
+    github_client, org_membership_cache_ttl, is_member, expect_requests
+):
+    c = Config()
+    c.GitHubOAuthenticator.allowed_organizations = {"org1"}
+    c.GitHubOAuthenticator.org_membership_cache_ttl = org_membership_cache_ttl
+    authenticator = GitHubOAuthenticator(config=c)
+
+    membership_requests = []
+
+    def org_membership(request):
+        membership_requests.append(request.url)
+        return HTTPResponse(request, 204 if is_member else 404)
+
+    client_hosts = github_client.hosts['api.github.com']
+    client_hosts.append((re.compile(r'/orgs/org1/members/user1'), org_membership))
+
+    for _ in range(2):
+        handler = github_client.handler_for_user(user_model("user1"))
+        auth_model = await authenticator.get_authenticated_user(handler, None)
+        assert bool(auth_model) == is_member
+
+    assert len(membership_requests) == expect_requests
+
+
+async def test_org_membership_cache_eviction(monkeypatch):
+    authenticator = GitHubOAuthenticator(org_membership_cache_ttl=10)
+    monkeypatch.setattr(github, "_ORG_MEMBERSHIP_CACHE_MAX_SIZE", 3)
+
+    for user in ("user1", "user2"):
+        authenticator._cache_org_membership(("org1", user))
+    # make the entries expire
+    for cache_key in authenticator._org_membership_cache:
+        authenticator._org_membership_cache[cache_key] -= 10
+
+    # expired entries are removed when adding new entries
+    authenticator._cache_org_membership(("org1", "user3"))
+    assert list(authenticator._org_membership_cache) == [("org1", "user3")]
+
+    # the oldest entries are removed when the cache is full
+    for user in ("user4", "user5", "user6"):
+        authenticator._cache_org_membership(("org1", user))
+    assert list(authenticator._org_membership_cache) == [
+        ("org1", "user4"),
+        ("org1", "user5"),
+        ("org1", "user6"),
+    ]
+
+
 @mark.parametrize(
     "test_variation_id,class_config,expect_config,expect_loglevel,expect_message",
     [